@@ -0,0 +1,60 @@
+"""
+Shared helpers for download_models.py and test_cache.py
+Keeps the repo list and cache traversal logic in one place so the two
+scripts can't drift apart
+"""
+
+import functools
+import os
+from pathlib import Path
+
+HIDREAM_REPO = 'HiDream-ai/HiDream-I1-Full'
+LLAMA_REPO = 'unsloth/Meta-Llama-3.1-8B-Instruct'
+REPOS = [HIDREAM_REPO, LLAMA_REPO]
+
+# Pin these to full commit SHAs (HfApi().model_info(repo_id).sha) for
+# reproducible builds: a pinned revision skips the main->SHA resolution
+# round-trip on every hub call and is immune to silent upstream pushes
+# that would invalidate the cache size heuristics. Settable via build args
+# so a rebuild can pin without editing the script.
+PINNED_REVISIONS = {
+    HIDREAM_REPO: os.environ.get('HIDREAM_REVISION', 'main'),
+    LLAMA_REPO: os.environ.get('LLAMA_REVISION', 'main'),
+}
+
+# Only pull safetensors weights plus configs/tokenizers - skips .bin pickle
+# duplicates, onnx exports, example images etc. and saves 30-50% of the bytes.
+# Every snapshot_download call must use these, including offline
+# (local_files_only=True) ones: hub 1.x validates the local snapshot against
+# the full tree listing filtered by the patterns passed to *that* call, so a
+# patternless offline call reports the intentionally skipped files as missing.
+ALLOW_PATTERNS = ['*.safetensors', '*.json', '*.txt', 'tokenizer*', '*.model']
+IGNORE_PATTERNS = ['*.bin', '*.msgpack', '*.onnx', '*.ot', '*.h5', '*.pt', '*.gguf', '*.png', '*.jpg']
+
+@functools.lru_cache(maxsize=1)
+def hf_cache_dir():
+    """Resolved HF cache directory (HF_HOME, or the image default)
+
+    Cached so callers can use it freely in loops without re-reading the
+    environment, and so tests can redirect it by clearing the cache after
+    setting HF_HOME.
+    """
+    return Path(os.environ.get('HF_HOME', '/opt/huggingface_cache'))
+
+def cache_size_bytes(root):
+    """Total size in bytes of all files under root (iterative os.scandir walk)
+
+    DirEntry.is_dir() uses the cached dirent type and stat() is called once
+    per file, roughly halving the syscalls of a rglob + stat approach across
+    the hundreds of thousands of blob files in the cache.
+    """
+    total = 0
+    stack = [root]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    total += entry.stat(follow_symlinks=False).st_size
+    return total
@@ -4,116 +4,431 @@ Model download and verification script for HiDream training
 This script downloads the required models and verifies they work offline
 """
 
+import asyncio
+import hashlib
+import json
 import os
+import random
+import shutil
+import subprocess
 import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Xet-backed repos: share one connection pool across parallel downloads and
+# raise its concurrency, so the two simultaneous snapshot_downloads don't pay
+# a TLS+TCP handshake per file. No-op (ignored) when hf_xet isn't installed.
+os.environ.setdefault('HF_XET_HIGH_PERFORMANCE', '1')
+
 from huggingface_hub import snapshot_download
-from pathlib import Path
 
-def download_with_retry(repo_id, max_retries=3):
+from _download_common import (
+    ALLOW_PATTERNS,
+    HIDREAM_REPO,
+    IGNORE_PATTERNS,
+    LLAMA_REPO,
+    PINNED_REVISIONS,
+    cache_size_bytes,
+    hf_cache_dir,
+)
+
+# Shards above this size get the multi-connection aria2c treatment
+LARGE_FILE_THRESHOLD = 1 << 30  # 1 GB
+
+def _prefetch_large_files(repo_id, allow_patterns=None, ignore_patterns=None):
+    """Fetch the repo's multi-GB LFS shards with aria2c before snapshot_download
+
+    aria2c opens 16 byte-range connections per file where a plain download
+    uses one, which is the difference between ~500 Mbps and multiple Gbps on
+    the big safetensors shards. Files land directly in the cache's blobs/
+    store under their SHA256 name, so the subsequent snapshot_download just
+    symlinks them instead of re-downloading. Only files the download itself
+    would fetch are prefetched - anything else would sit orphaned in blobs/.
+    Any failure here is non-fatal - snapshot_download remains the source of
+    truth.
+    """
+    if shutil.which('aria2c') is None:
+        return
+    revision = PINNED_REVISIONS.get(repo_id, 'main')
+    try:
+        from huggingface_hub import HfApi, hf_hub_url
+        from huggingface_hub.utils import filter_repo_objects
+        info = HfApi().repo_info(repo_id, revision=revision, files_metadata=True)
+    except Exception as e:
+        print(f'⚠️ Could not list files for {repo_id}: {e}')
+        return
+
+    wanted = set(filter_repo_objects(
+        (s.rfilename for s in info.siblings),
+        allow_patterns=allow_patterns,
+        ignore_patterns=ignore_patterns
+    ))
+
+    blobs_dir = os.path.join(
+        hf_cache_dir(), f"models--{repo_id.replace('/', '--')}", 'blobs'
+    )
+    os.makedirs(blobs_dir, exist_ok=True)
+
+    for sibling in info.siblings:
+        lfs = sibling.lfs
+        if lfs is None or lfs.size < LARGE_FILE_THRESHOLD:
+            continue
+        if sibling.rfilename not in wanted:
+            continue
+        blob_path = os.path.join(blobs_dir, lfs.sha256)
+        if os.path.exists(blob_path):
+            continue
+        url = hf_hub_url(repo_id, sibling.rfilename, revision=revision)
+        print(f'🚅 aria2c prefetch: {sibling.rfilename} ({lfs.size / (1024**3):.1f} GB)')
+        result = subprocess.run(
+            ['aria2c', '-x', '16', '-s', '16', '-k', '1M', '--file-allocation=none',
+             '--dir', blobs_dir, '-o', lfs.sha256, url]
+        )
+        if result.returncode != 0:
+            print(f'⚠️ aria2c failed for {sibling.rfilename} - snapshot_download will fetch it')
+            for leftover in (blob_path, blob_path + '.aria2'):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+
+def download_with_retry(repo_id, max_retries=3, allow_patterns=None, ignore_patterns=None):
     """Download a model with retry logic"""
+    try:
+        _prefetch_large_files(repo_id, allow_patterns=allow_patterns,
+                              ignore_patterns=ignore_patterns)
+    except Exception as e:
+        print(f'⚠️ Prefetch failed for {repo_id}: {e}')
     for attempt in range(max_retries):
         try:
             print(f'📥 Downloading {repo_id} (attempt {attempt + 1}/{max_retries})...')
             snapshot_download(
                 repo_id=repo_id,
-                cache_dir='/opt/huggingface_cache',
-                resume_download=True,
-                local_files_only=False
+                revision=PINNED_REVISIONS.get(repo_id, 'main'),
+                cache_dir=hf_cache_dir(),
+                local_files_only=False,
+                max_workers=8,
+                allow_patterns=allow_patterns,
+                ignore_patterns=ignore_patterns
             )
             print(f'✅ {repo_id} downloaded successfully!')
             return True
         except Exception as e:
             print(f'⚠️ Attempt {attempt + 1} failed for {repo_id}: {e}')
             if attempt < max_retries - 1:
-                time.sleep(10)
+                # Exponential backoff with jitter: quick retry on a transient
+                # blip, without hammering the Hub in lockstep on a 429/503
+                delay = min(60, 2 ** attempt + random.uniform(0, 1))
+                retry_after = getattr(getattr(e, 'response', None), 'headers', {}).get('Retry-After')
+                if retry_after:
+                    try:
+                        delay = max(delay, float(retry_after))
+                    except ValueError:
+                        pass
+                print(f'⏳ Retrying in {delay:.1f}s...')
+                time.sleep(delay)
             else:
                 print(f'❌ FATAL: Failed to download {repo_id} after {max_retries} attempts')
                 sys.exit(1)  # HARD FAIL THE BUILD
     return False
 
-def verify_models():
-    """Verify that models can be loaded offline"""
-    print('🎉 All models downloaded - now verifying...')
-    
+def _verify_blob(path, expected_sha256):
+    """Return True if the file at path hashes to the expected SHA256"""
+    h = hashlib.sha256()
+    with open(path, 'rb', buffering=0) as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest() == expected_sha256
+
+def verify_blob_hashes(repo_id):
+    """Check cached LFS blobs against the SHA256 hashes the Hub reports
+
+    This proves byte-exact cache content, which the loadability tests in
+    verify_models can't - a truncated shard still has a valid config.
+    Returns True when every blob matched and False when the check had to be
+    skipped; a hash mismatch hard-fails the build instead of returning.
+    """
+    print(f'🔐 Hash-verifying cached blobs for {repo_id}...')
+    revision = PINNED_REVISIONS.get(repo_id, 'main')
     try:
-        from transformers import AutoTokenizer, AutoConfig
-        from diffusers import AutoencoderKL
-        from diffusers.configuration_utils import ConfigMixin
-        
-        # Test 1: Llama model offline loading (transformers)
+        snapshot_path = snapshot_download(
+            repo_id, revision=revision, cache_dir=hf_cache_dir(),
+            local_files_only=True,
+            allow_patterns=ALLOW_PATTERNS, ignore_patterns=IGNORE_PATTERNS
+        )
+    except Exception as e:
+        print(f'⚠️ Could not resolve the local snapshot for {repo_id}: {e}')
+        print('💡 Skipping hash verification for this repo')
+        return False
+    try:
+        from huggingface_hub import HfApi
+        siblings = HfApi().repo_info(repo_id, revision=revision, files_metadata=True).siblings
+    except Exception as e:
+        print(f'⚠️ Could not fetch file metadata for {repo_id}: {e}')
+        print('💡 Skipping hash verification for this repo')
+        return False
+
+    def check(sibling):
+        path = os.path.join(snapshot_path, sibling.rfilename)
+        if not os.path.exists(path):
+            return None  # skipped by allow_patterns, nothing to verify
+        if _verify_blob(path, sibling.lfs.sha256):
+            return None
+        return sibling.rfilename
+
+    lfs_siblings = [s for s in siblings if s.lfs is not None]
+    # Hashing is I/O-bound and hashlib releases the GIL, so threads scale
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        corrupt = [name for name in executor.map(check, lfs_siblings) if name]
+
+    if corrupt:
+        print(f'❌ FATAL: Hash mismatch for {repo_id}: {corrupt}')
+        sys.exit(1)  # HARD FAIL THE BUILD
+    print(f'✅ Blobs verified for {repo_id}')
+    return True
+
+def verify_llama():
+    """Verify the Llama tokenizer loads offline (transformers)
+
+    Returns True on success; failures are reported as warnings (the build
+    continues) but count against the .verified marker.
+    """
+    try:
+        from transformers import AutoTokenizer
+
+        # The tokenizer load already reads config.json + tokenizer_config.json,
+        # so a separate AutoConfig test would be redundant
         print('🔍 Test 1: Loading Llama tokenizer offline...')
         tokenizer = AutoTokenizer.from_pretrained(
-            'unsloth/Meta-Llama-3.1-8B-Instruct',
-            cache_dir='/opt/huggingface_cache',
+            LLAMA_REPO,
+            revision=PINNED_REVISIONS[LLAMA_REPO],
+            cache_dir=hf_cache_dir(),
             local_files_only=True
         )
         print('✅ Test 1 PASSED')
-        
-        # Test 2: Llama config offline loading  
-        print('🔍 Test 2: Loading Llama config offline...')
-        llama_config = AutoConfig.from_pretrained(
-            'unsloth/Meta-Llama-3.1-8B-Instruct',
-            cache_dir='/opt/huggingface_cache', 
-            local_files_only=True
+        return True
+    except Exception as e:
+        print(f'⚠️ VERIFICATION WARNING: {e}')
+        print('💡 Models downloaded successfully, continuing build')
+        return False
+
+def verify_hidream():
+    """Verify the HiDream VAE config parses and its weights are on disk
+
+    Instantiating the VAE just to prove it's cached would allocate hundreds
+    of MB of tensors (and potentially init CUDA); parsing the config JSON
+    directly keeps diffusers off the verification critical path entirely,
+    and the weights file itself is a pure presence check. Returns True on
+    success; failures are reported as warnings (the build continues) but
+    count against the .verified marker.
+    """
+    try:
+        from huggingface_hub import try_to_load_from_cache
+
+        print('🔍 Test 2: Checking HiDream VAE config and weights are cached...')
+        vae_config = try_to_load_from_cache(
+            HIDREAM_REPO,
+            'vae/config.json',
+            cache_dir=hf_cache_dir(),
+            revision=PINNED_REVISIONS[HIDREAM_REPO]
         )
-        print('✅ Test 2 PASSED')
-        
-        # Test 3: HiDream VAE loading (diffusers)
-        print('🔍 Test 3: Loading HiDream VAE offline...')
-        vae = AutoencoderKL.from_pretrained(
-            'HiDream-ai/HiDream-I1-Full',
-            subfolder='vae',
-            cache_dir='/opt/huggingface_cache',
-            local_files_only=True
+        if not isinstance(vae_config, str):
+            raise FileNotFoundError('HiDream vae/config.json not found in cache')
+        with open(vae_config) as f:
+            json.load(f)  # corrupt JSON should fail here, not at training time
+        vae_weights = try_to_load_from_cache(
+            HIDREAM_REPO,
+            'vae/diffusion_pytorch_model.safetensors',
+            cache_dir=hf_cache_dir(),
+            revision=PINNED_REVISIONS[HIDREAM_REPO]
         )
-        print('✅ Test 3 PASSED')
-        
-        # Test 4: Check cache size
-        cache_path = Path('/opt/huggingface_cache')
-        if cache_path.exists():
-            total_size = sum(f.stat().st_size for f in cache_path.rglob('*') if f.is_file())
-            size_gb = total_size / (1024**3)
-            print(f'📊 Cache size: {size_gb:.1f} GB')
-            
-            if size_gb < 20:  # Reduced threshold - HiDream might be smaller than expected
-                print(f'⚠️ WARNING: Cache size is {size_gb:.1f} GB (expected >20GB)')
-                print('💡 Continuing anyway - models downloaded successfully')
+        if not isinstance(vae_weights, str):
+            raise FileNotFoundError(
+                'HiDream vae/diffusion_pytorch_model.safetensors not found in cache'
+            )
+        print('✅ Test 2 PASSED')
+        return True
+    except Exception as e:
+        print(f'⚠️ VERIFICATION WARNING: {e}')
+        print('💡 Models downloaded successfully, continuing build')
+        return False
+
+def _cache_fingerprint():
+    """Concatenated commit SHAs the cache currently points at, or None
+
+    Reads each repo's refs/<revision> pointer (falling back to the pinned
+    SHA itself when the revision is already a commit). Returns None when a
+    pointer is missing, which disables the verification shortcut.
+    """
+    parts = []
+    for repo_id in [HIDREAM_REPO, LLAMA_REPO]:
+        revision = PINNED_REVISIONS.get(repo_id, 'main')
+        ref_path = hf_cache_dir() / f"models--{repo_id.replace('/', '--')}" / 'refs' / revision
+        if ref_path.is_file():
+            parts.append(ref_path.read_text().strip())
+        elif revision != 'main':
+            parts.append(revision)  # pinned SHAs don't get a refs file
         else:
+            return None
+    return '\n'.join(parts)
+
+def _verification_marker():
+    return hf_cache_dir() / '.verified'
+
+def _verification_cached():
+    """True if the cache was already verified at its current commit SHAs
+
+    Docker layer caching re-runs this script against identical cache
+    contents; the marker lets those runs skip the expensive loads.
+    """
+    fingerprint = _cache_fingerprint()
+    marker = _verification_marker()
+    try:
+        return fingerprint is not None and marker.read_text() == fingerprint
+    except OSError:
+        return False
+
+def _has_repo_dir(root, needle):
+    """True if a top-level cache entry (models--{org}--{name}) matches needle
+
+    The HF cache keeps one directory per repo at the top level, so a single
+    non-recursive scandir answers this - no need to walk every snapshot
+    subdirectory and materialize thousands of Path objects.
+    """
+    with os.scandir(root) as it:
+        return any(needle in entry.name.lower() for entry in it if entry.is_dir())
+
+def verify_models(repos_verified=False):
+    """Verify the cache as a whole (size and expected directories)
+
+    repos_verified says whether every per-repo check (blob hashes and
+    loadability) passed; the .verified marker is only written when that and
+    the cache-wide checks all genuinely succeeded, so a warned-through run
+    never pins the cache as verified.
+    """
+    if _verification_cached():
+        print('✅ Verification cached - contents unchanged since last successful verify')
+        return
+
+    print('🎉 All models downloaded - now verifying...')
+
+    try:
+        # Test 3: Check cache size per repo - resolving each snapshot path and
+        # sizing only that repo's folder skips unrelated cache entries, .lock
+        # files and partial downloads that a whole-cache walk would count
+        if not hf_cache_dir().exists():
             print('❌ FATAL: Cache directory does not exist')
             sys.exit(1)
-            
-        # Test 5: Check that key files exist
-        print('🔍 Test 5: Checking critical files exist...')
-        cache_dirs = list(Path('/opt/huggingface_cache').glob('**/'))
-        hidream_found = any('hidream' in str(d).lower() for d in cache_dirs)
-        llama_found = any('llama' in str(d).lower() or 'meta' in str(d).lower() for d in cache_dirs)
-        
-        if hidream_found and llama_found:
-            print('✅ Test 5 PASSED - Found both model directories')
+
+        def repo_size(repo_id):
+            snapshot_path = snapshot_download(
+                repo_id, revision=PINNED_REVISIONS.get(repo_id, 'main'),
+                cache_dir=hf_cache_dir(), local_files_only=True,
+                allow_patterns=ALLOW_PATTERNS, ignore_patterns=IGNORE_PATTERNS
+            )
+            # Size the repo folder (two levels above the snapshot) so blobs
+            # are counted once as real files, not through snapshot symlinks
+            return cache_size_bytes(os.path.dirname(os.path.dirname(snapshot_path)))
+
+        # The two walks hit disjoint directories and the GIL is released
+        # during stat calls, so threads overlap the disk I/O
+        repos = [HIDREAM_REPO, LLAMA_REPO]
+        with ThreadPoolExecutor(max_workers=len(repos)) as executor:
+            sizes = list(executor.map(repo_size, repos))
+        for repo_id, size in zip(repos, sizes):
+            print(f'📊 {repo_id}: {size / (1024**3):.1f} GB')
+
+        size_gb = sum(sizes) / (1024**3)
+        print(f'📊 Cache size: {size_gb:.1f} GB')
+
+        size_ok = size_gb >= 18  # Safetensors-only download is smaller than the full repos
+        if not size_ok:
+            print(f'⚠️ WARNING: Cache size is {size_gb:.1f} GB (expected >18GB)')
+            print('💡 Continuing anyway - models downloaded successfully')
+
+
+        # Test 4: Check that key files exist
+        print('🔍 Test 4: Checking critical files exist...')
+        hidream_found = _has_repo_dir(hf_cache_dir(), 'hidream')
+        llama_found = (_has_repo_dir(hf_cache_dir(), 'llama')
+                       or _has_repo_dir(hf_cache_dir(), 'meta'))
+
+        dirs_ok = hidream_found and llama_found
+        if dirs_ok:
+            print('✅ Test 4 PASSED - Found both model directories')
         else:
             print(f'⚠️ WARNING: Model directories check - HiDream: {hidream_found}, Llama: {llama_found}')
-        
+
         print('🎉 ALL VERIFICATION TESTS PASSED!')
         print('💡 Training will start instantly without downloads')
-        
+
+        # Stamp the verified SHAs so identical cache contents skip all this -
+        # but only when every check genuinely passed, otherwise one build with
+        # an unreachable Hub would pin a possibly corrupt cache as verified
+        if repos_verified and size_ok and dirs_ok:
+            fingerprint = _cache_fingerprint()
+            if fingerprint is not None:
+                _verification_marker().write_text(fingerprint)
+
     except Exception as e:
         print(f'⚠️ VERIFICATION WARNING: {e}')
         print('💡 Models downloaded successfully, continuing build')
         print('🔧 The specific verification failed, but files are cached')
         # Don't fail the build if verification has issues - models are downloaded
         
+async def _download_and_verify(repo_id, verify_fn):
+    """Download one repo, then verify it while the other may still be fetching
+
+    Returns True only when both the hash check and the loadability test
+    genuinely passed (or verification is already cached at this revision).
+    """
+    await asyncio.to_thread(
+        download_with_retry, repo_id,
+        allow_patterns=ALLOW_PATTERNS,
+        ignore_patterns=IGNORE_PATTERNS
+    )
+    if _verification_cached():
+        print(f'✅ {repo_id} already verified at this revision - skipping checks')
+        return True
+    hashes_ok = await asyncio.to_thread(verify_blob_hashes, repo_id)
+    loads_ok = await asyncio.to_thread(verify_fn)
+    return bool(hashes_ok) and bool(loads_ok)
+
+async def _pipeline():
+    # Both repos download concurrently (they touch disjoint cache subtrees),
+    # and each repo's verification starts the moment its own download lands
+    # instead of waiting for the slower repo to finish
+    results = await asyncio.gather(
+        _download_and_verify(HIDREAM_REPO, verify_hidream),
+        _download_and_verify(LLAMA_REPO, verify_llama),
+    )
+    return all(results)
+
+def _warm_imports():
+    """Populate sys.modules with transformers in the background
+
+    The import takes several seconds (it drags in torch, numpy, safetensors)
+    but only needs CPU, so running it while the downloads wait on the network
+    makes the later 'from transformers import AutoTokenizer' near-instant.
+    """
+    try:
+        import transformers  # noqa: F401
+    except Exception:
+        pass  # verify_llama will report the real error
+
 def main():
     """Main function to download and verify models"""
     print('🚀 Starting model pre-download process...')
-    
-    # Download both models (exactly matching your config)
-    download_with_retry('HiDream-ai/HiDream-I1-Full')
-    download_with_retry('unsloth/Meta-Llama-3.1-8B-Instruct')
-    
-    # Verify everything works
-    verify_models()
-    
+
+    # Overlap the heavy transformers import with the network-bound downloads
+    threading.Thread(target=_warm_imports, daemon=True).start()
+
+    # Download both models and run the per-repo checks (exactly matching
+    # your config) - a failed download still hard-fails via sys.exit
+    repos_verified = asyncio.run(_pipeline())
+
+    # Cache-wide checks once everything is on disk
+    verify_models(repos_verified=repos_verified)
+
     print('🎊 Model caching complete!')
 
 if __name__ == '__main__':
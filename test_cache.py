@@ -5,15 +5,28 @@ Run this in your RunPod environment to check cache status
 """
 
 import os
+import re
 import sys
 from pathlib import Path
-from huggingface_hub import try_to_load_from_cache
+from huggingface_hub import snapshot_download
 
-def check_model_cache(repo_id, cache_dir="/opt/huggingface_cache"):
+from _download_common import (
+    ALLOW_PATTERNS,
+    HIDREAM_REPO,
+    IGNORE_PATTERNS,
+    LLAMA_REPO,
+    PINNED_REVISIONS,
+    REPOS,
+    cache_size_bytes,
+    hf_cache_dir,
+)
+
+def check_model_cache(repo_id, cache_dir=None):
     """Check if a model is fully cached locally"""
     print(f"\n🔍 Checking cache for: {repo_id}")
-    
+
     # Check if cache directory exists
+    cache_dir = cache_dir or hf_cache_dir()
     cache_path = Path(cache_dir)
     if not cache_path.exists():
         print(f"❌ Cache directory not found: {cache_dir}")
@@ -21,7 +34,7 @@ def check_model_cache(repo_id, cache_dir="/opt/huggingface_cache"):
     
     # Files we expect for HiDream models
     required_files = {
-        "HiDream-ai/HiDream-I1-Full": [
+        HIDREAM_REPO: [
             "config.json",
             "model.safetensors.index.json", 
             "diffusion_pytorch_model.safetensors",  # VAE
@@ -29,7 +42,7 @@ def check_model_cache(repo_id, cache_dir="/opt/huggingface_cache"):
             "tokenizer_config.json",
             "special_tokens_map.json"
         ],
-        "unsloth/Meta-Llama-3.1-8B-Instruct": [
+        LLAMA_REPO: [
             "config.json",
             "tokenizer.json", 
             "tokenizer_config.json",
@@ -48,14 +61,27 @@ def check_model_cache(repo_id, cache_dir="/opt/huggingface_cache"):
     try:
         cached_files = []
         missing_files = []
-        
+
+        # Resolve the snapshot directory once (instant when cached) and then
+        # check each file with a plain stat - the old per-file
+        # try_to_load_from_cache loop re-read refs/main and re-walked the
+        # cache layout for every single filename
+        try:
+            snapshot_path = snapshot_download(
+                repo_id, revision=PINNED_REVISIONS.get(repo_id, 'main'),
+                cache_dir=cache_dir, local_files_only=True,
+                allow_patterns=ALLOW_PATTERNS, ignore_patterns=IGNORE_PATTERNS
+            )
+        except Exception:
+            print(f"❌ No local snapshot found for {repo_id}")
+            return False
+
         for filename in files_to_check:
-            cached_path = try_to_load_from_cache(repo_id, filename, cache_dir=cache_dir)
-            if cached_path:
+            if os.path.exists(os.path.join(snapshot_path, filename)):
                 cached_files.append(filename)
             else:
                 missing_files.append(filename)
-        
+
         if cached_files:
             print(f"✅ Found cached files ({len(cached_files)}): {cached_files[:3]}{'...' if len(cached_files) > 3 else ''}")
             
@@ -79,8 +105,8 @@ def simulate_training_load():
         # Test Llama components
         print("  Loading Llama tokenizer...")
         tokenizer = AutoTokenizer.from_pretrained(
-            'unsloth/Meta-Llama-3.1-8B-Instruct',
-            cache_dir=os.environ.get('HF_HOME', '/opt/huggingface_cache'),
+            LLAMA_REPO,
+            cache_dir=hf_cache_dir(),
             local_files_only=True
         )
         print("  ✅ Llama tokenizer loaded successfully")
@@ -88,8 +114,8 @@ def simulate_training_load():
         # Test HiDream config
         print("  Loading HiDream config...")
         config = AutoConfig.from_pretrained(
-            'HiDream-ai/HiDream-I1-Full', 
-            cache_dir=os.environ.get('HF_HOME', '/opt/huggingface_cache'),
+            HIDREAM_REPO,
+            cache_dir=hf_cache_dir(),
             local_files_only=True
         )
         print("  ✅ HiDream config loaded successfully")
@@ -105,18 +131,31 @@ def main():
     print("=" * 60)
     
     # Models your training uses
-    models = [
-        "HiDream-ai/HiDream-I1-Full",
-        "unsloth/Meta-Llama-3.1-8B-Instruct"
-    ]
+    models = REPOS
     
-    cache_dir = os.environ.get('HF_HOME', '/opt/huggingface_cache')
+    cache_dir = hf_cache_dir()
     print(f"📁 Cache directory: {cache_dir}")
-    
+
+    # Fast negative path: if a repo's revision pointer is missing it can't be
+    # cached, so fail with two stats instead of walking the whole cache first.
+    # The hub only writes a refs file for branch/tag revisions - a pinned
+    # commit SHA has no refs entry, so stat its snapshot directory instead
+    for model in models:
+        repo_dir = Path(cache_dir) / f"models--{model.replace('/', '--')}"
+        revision = PINNED_REVISIONS.get(model, 'main')
+        if re.fullmatch(r'[0-9a-f]{40}', revision):
+            pointer = repo_dir / "snapshots" / revision
+        else:
+            pointer = repo_dir / "refs" / revision
+        if not pointer.exists():
+            print(f"❌ FAILED: {model} not cached (no {pointer})")
+            print("💡 First training run will still download missing components")
+            sys.exit(2)
+
     # Check overall cache size
     if Path(cache_dir).exists():
         try:
-            total_size = sum(f.stat().st_size for f in Path(cache_dir).rglob('*') if f.is_file())
+            total_size = cache_size_bytes(cache_dir)
             size_gb = total_size / (1024**3)
             print(f"💾 Total cache size: {size_gb:.2f} GB")
         except: